@@ -1,14 +1,45 @@
 import requests #Dependency used for HTTP connections
 import html
 import json
+import csv
+import io
 from configparser import ConfigParser
 import psycopg2 #Dependency used for connection to postgreSql database
 import time
 import math
+import heapq
+import re
+import argparse
 import logging
+import os
+import sys
+import functools
+import cProfile
+import pstats
+import tracemalloc
+try:
+    import resource # Not available on Windows, then RSS high-water mark is just not reported
+except ImportError:
+    resource = None
+try:
+    # Optional, needed only for Parquet snapshot sink and importing snapshots
+    import pyarrow
+    import pyarrow.parquet
+    import pyarrow.csv
+    import pyarrow.compute
+except ImportError:
+    pyarrow = None
+try:
+    import brotli # Optional, lets urllib3 decode brotli compressed responses
+    ACCEPT_ENCODING = 'gzip, deflate, br'
+except ImportError:
+    ACCEPT_ENCODING = 'gzip, deflate'
 
-#List used for keeping track of number of queries in the last minute
-LAST_MINUTE_EVENTS = list()
+WDQS_URL = 'https://query.wikidata.org/sparql'
+# Proper user-agent to identify the caller as specified by WikiData query API specification
+USER_AGENT = 'Wikidata schema extraction Bot/1.0 (https://github.com/vehiginters/wikidata_export, vehiginters@gmail.com)'
+# Pool of SPARQL endpoints, filled from properties.ini by setSparqlEndpoints
+SPARQL_ENDPOINTS = list()
 WD_PREFIXES = {
     "http://www.bigdata.com/rdf#": "bd",
     "http://creativecommons.org/ns#": "cc",
@@ -67,16 +98,15 @@ def insertWikidataPrefixes(connection):
     connection.commit()
     cur.close()
 
-def countPastQueries():
-    # Function used to go over the last event list and cut off the list after finding the first expired event
-    global LAST_MINUTE_EVENTS
+def countPastQueries(events):
+    # Function used to go over the given endpoint event list and cut off the list after finding the first expired event
     TIME_WINDOW = 60
     tim=time.time()  # called only once
-    for idx in range(len(LAST_MINUTE_EVENTS)-1,-1,-1):
-        if LAST_MINUTE_EVENTS[idx]+TIME_WINDOW<= tim:
-            LAST_MINUTE_EVENTS[:idx+1]=""
+    for idx in range(len(events)-1,-1,-1):
+        if events[idx]+TIME_WINDOW<= tim:
+            events[:idx+1]=""
             break
-    return len(LAST_MINUTE_EVENTS)
+    return len(events)
 
 def config(section, filename='properties.ini'):
     parser = ConfigParser()
@@ -94,6 +124,12 @@ def config(section, filename='properties.ini'):
     # Returns config as a dict
     return conf
 
+def configSections(prefix, filename='properties.ini'):
+    # Returns names of all config sections starting with the given prefix
+    parser = ConfigParser()
+    parser.read(filename)
+    return [section for section in parser.sections() if section.startswith(prefix)]
+
 SCHEMA = 'sample'
 def setSchemaName():
     global SCHEMA
@@ -118,6 +154,115 @@ def setLogLevel():
             raise Exception("Invalid log level({}), valid log levels(DEBUG,INFO,WARNING,ERROR,CRITICAL)".format(loggingConfig['level']))
     print("Set LOG_LEVEL = {}".format(loggingConfig['level']))
 
+PROFILING_DIR = None # Set to output directory, when profiling mode is enabled
+PROFILING_TOP = 15
+PROFILE_SUMMARY = {}
+# Functions that build and execute SQL, their time minus cursor.execute time is counted as SQL string building
+SQL_WRITERS = ('insertWikidataPrefixes', 'insertClasses', 'insertProperties', 'insertClassPropertyRelations',
+    'insertConstraintRelations', 'updateClassPropertyRelations', 'insertClassClassRelations', 'insertPropObjCount',
+    'insertPropertyPropertyRelations', 'insertClassPropertyClassRelations', 'removeRefinedPreviewRelations')
+# Functions called only from within SQL writers, their database time is also subtracted from the writers time
+SQL_WRITER_HELPERS = ('tableHasRows',)
+def setProfiling():
+    # Profiling is opt-in, as tracemalloc slows everything down quite a bit
+    global PROFILING_DIR, PROFILING_TOP
+    profilingConfig = config('profiling')
+    if not profilingConfig or profilingConfig.get('enabled', 'false').lower() != 'true':
+        return
+    PROFILING_TOP = int(profilingConfig.get('top', PROFILING_TOP))
+    PROFILING_DIR = os.path.join(profilingConfig.get('output_dir', 'profiles'), time.strftime("%Y%m%d%H%M", time.localtime()))
+    os.makedirs(PROFILING_DIR, exist_ok=True)
+    tracemalloc.start()
+    logging.info("Profiling enabled, writing results to {}".format(PROFILING_DIR))
+
+def getRssHighWater():
+    # Peak resident set size of the process in MB
+    if resource is None:
+        return None
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return maxRss / (1024 * 1024) if sys.platform == 'darwin' else maxRss / 1024
+
+def getFunctionKeys(names):
+    # Profiler stats keys (file, line, name) of the given module level functions, so that sink methods
+    # with the same names as SQL writers aren't matched
+    keys = set()
+    for name in names:
+        code = getattr(globals()[name], '__wrapped__', globals()[name]).__code__
+        keys.add((code.co_filename, code.co_firstlineno, code.co_name))
+    return keys
+
+def getTimeSplit(stats):
+    # Split stage time into network, rate limit waiting, result parsing, SQL string building and database time
+    split = {'network': 0.0, 'waiting': 0.0, 'resultParsing': 0.0, 'sqlBuilding': 0.0, 'database': 0.0}
+    writerKeys = getFunctionKeys(SQL_WRITERS)
+    writerCallerKeys = writerKeys | getFunctionKeys(SQL_WRITER_HELPERS)
+    writerDatabase = 0.0
+    for key, (cc, nc, tt, ct, callers) in stats.stats.items():
+        fileName, line, funcName = key
+        if funcName == 'post' and fileName.endswith(os.path.join('requests', 'sessions.py')):
+            split['network'] = split['network'] + ct
+        elif funcName == '<built-in method time.sleep>':
+            split['waiting'] = split['waiting'] + ct
+        elif funcName == 'parseCsvRows':
+            split['resultParsing'] = split['resultParsing'] + ct
+        elif funcName.startswith(("<method 'execute' of 'psycopg2", "<method 'copy_expert' of 'psycopg2", "<method 'commit' of 'psycopg2")):
+            split['database'] = split['database'] + tt
+            # Only the part called by SQL writers is subtracted from their time, commits of sinks are not part of it
+            writerDatabase = writerDatabase + sum(callerStats[2] for caller, callerStats in callers.items() if caller in writerCallerKeys)
+        elif key in writerKeys:
+            split['sqlBuilding'] = split['sqlBuilding'] + ct
+    split['sqlBuilding'] = max(split['sqlBuilding'] - writerDatabase, 0.0)
+    return split
+
+def profileStage(func):
+    # Wraps export stage with cProfile and tracemalloc, when profiling mode is enabled
+    # Results for each stage are dumped into the profiling directory as they finish
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if PROFILING_DIR is None:
+            return func(*args, **kwargs)
+        stageName = func.__name__
+        stageRuns = sum(1 for name in PROFILE_SUMMARY if name.split('#')[0] == stageName)
+        if stageRuns > 0:
+            stageName = "{}#{}".format(stageName, stageRuns + 1)
+        tracemalloc.reset_peak()
+        # Top allocators are reported as difference from this snapshot, so data kept from earlier stages isn't counted
+        startSnapshot = tracemalloc.take_snapshot()
+        rssBefore = getRssHighWater()
+        profiler = cProfile.Profile()
+        startTime = time.time()
+        profiler.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            wallTime = time.time() - startTime
+            currentMemory, peakMemory = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            profileFile = os.path.join(PROFILING_DIR, stageName.replace('#', '_') + '.prof')
+            profiler.dump_stats(profileFile)
+            stats = pstats.Stats(profiler)
+            hotSpots = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:PROFILING_TOP]
+            rssAfter = getRssHighWater()
+            PROFILE_SUMMARY[stageName] = {
+                'wallTime': wallTime,
+                'rssHighWaterMb': rssAfter,
+                'rssHighWaterGrowthMb': rssAfter - rssBefore if rssAfter is not None else None,
+                'tracedPeakMb': peakMemory / (1024 * 1024),
+                'tracedCurrentMb': currentMemory / (1024 * 1024),
+                'timeSplit': getTimeSplit(stats),
+                'topAllocators': [{'location': str(stat.traceback), 'sizeMb': stat.size / (1024 * 1024), 'sizeDiffMb': stat.size_diff / (1024 * 1024),
+                    'count': stat.count, 'countDiff': stat.count_diff} for stat in snapshot.compare_to(startSnapshot, 'lineno')[:PROFILING_TOP]],
+                'hotSpots': [{'function': "{}:{}({})".format(*key), 'calls': value[1], 'totalTime': value[2], 'cumulativeTime': value[3]}
+                    for key, value in hotSpots],
+            }
+            with open(os.path.join(PROFILING_DIR, 'summary.json'), 'w') as summaryFile:
+                json.dump(PROFILE_SUMMARY, summaryFile, indent=2)
+            logging.info("Stage {} took {:.0f}s, traced memory peak {:.1f}MB, RSS high-water {}MB".format(
+                stageName, wallTime, peakMemory / (1024 * 1024), rssAfter))
+    return wrapper
+
 DB_CON = None
 def getDbCon():
     params = config('postgreSqlConnection')
@@ -133,50 +278,196 @@ def getDbCon():
             raise Exception("Failed to connect to PostgreSQL database - {}".format(error))
     return DB_CON
 
-def queryWikiData(query, retries=0):
-    global LAST_MINUTE_EVENTS
-    # Make POST request to wikidata sparsql service
-    lastMinuteEvents = countPastQueries()
-    if lastMinuteEvents > 10:
-        # If more than 10 queries been made in the last minute wait for a while, not to fail
+# Seconds a failing endpoint is taken out of the pool, and how many failures in a row trigger that
+ENDPOINT_EJECT_TIME = 300
+ENDPOINT_MAX_FAILURES = 3
+def setSparqlEndpoints():
+    # Read the SPARQL endpoint pool from config, every [sparqlEndpoint.<name>] section is one endpoint
+    # If no endpoints are configured, only the public Wikidata query service is used
+    global SPARQL_ENDPOINTS
+    SPARQL_ENDPOINTS = list()
+    for section in configSections('sparqlEndpoint'):
+        endpointConfig = config(section)
+        if 'url' not in endpointConfig:
+            raise Exception("Properties file section {} missing endpoint url".format(section))
+        name = section.split('.', 1)[1] if '.' in section else section
+        SPARQL_ENDPOINTS.append(newEndpoint(name, endpointConfig['url'],
+            int(endpointConfig.get('rate_limit', 0)),
+            endpointConfig.get('label_service', 'true').lower() == 'true'))
+    if not SPARQL_ENDPOINTS:
         # Limit is not really 10, but from testing seems between 10-20
-        logging.info("More than 10 queries in the last minute, waiting for 60s")
-        time.sleep(61)
+        SPARQL_ENDPOINTS.append(newEndpoint('wdqs', WDQS_URL, 10, True))
+    logging.info("Using SPARQL endpoints - {}".format(", ".join(e['name'] for e in SPARQL_ENDPOINTS)))
+
+def newEndpoint(name, url, rateLimit, labelService):
+    # rateLimit is max queries per minute, 0 means the endpoint is not throttled
+    return {'name': name, 'url': url, 'rateLimit': rateLimit, 'labelService': labelService, 'session': None,
+            'events': list(), 'latency': None, 'errorRate': 0.0, 'failures': 0, 'ejectedUntil': 0}
+
+def getEndpointSession(endpoint):
+    # Each endpoint keeps its own session, so connections are kept alive and TLS handshake is done only once
+    if endpoint['session'] is None:
+        session = requests.Session()
+        session.mount(endpoint['url'], requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        session.headers.update({'User-Agent': USER_AGENT,
+                                'Accept-Encoding': ACCEPT_ENCODING,
+                                'Accept': 'text/csv'})
+        endpoint['session'] = session
+    return endpoint['session']
+
+def addQueryPrefixes(query):
+    # WDQS predefines wd:, wdt:, wikibase:, bd: and other Wikidata prefixes, but other SPARQL engines like QLever don't,
+    # so declare all of the Wikidata prefixes used in the query
+    declarations = ["PREFIX {}: <{}>".format(prefix, iri) for iri, prefix in WD_PREFIXES.items()
+                    if re.search(r"(?<![\w<:/#.-]){}:".format(prefix), query)]
+    return "\n".join(declarations + [query])
+
+def parseCsvRows(content):
+    # CSV is the most compact result format, that all the endpoints support, and all of our queries need only plain values
+    # So skip the header and yield each result row as a tuple of strings in the order of SELECT variables
+    # Response body is decoded while reading it, so only the raw bytes are kept in memory and not a decoded copy of them
+    reader = csv.reader(io.TextIOWrapper(io.BytesIO(content), encoding='utf-8', newline=''))
+    next(reader, None)
+    for row in reader:
+        yield tuple(row)
+
+def endpointWaitTime(endpoint):
+    # Seconds until the endpoint can take a new query
+    tim = time.time()
+    waitTime = endpoint['ejectedUntil'] - tim
+    if endpoint['rateLimit'] and countPastQueries(endpoint['events']) >= endpoint['rateLimit']:
+        waitTime = max(waitTime, endpoint['events'][0] + 60 - tim)
+    return max(waitTime, 0)
+
+def endpointScore(endpoint):
+    # Lower is better, endpoints without any queries yet get tried first
+    # Endpoints that have failed, but never succeeded, have no latency, so they are scored with the slowest measured latency
+    latency = endpoint['latency']
+    if latency is None:
+        if endpoint['errorRate'] == 0:
+            return 0
+        latency = max((e['latency'] for e in SPARQL_ENDPOINTS if e['latency'] is not None), default=1.0)
+    return latency * (1 + 10 * endpoint['errorRate'])
+
+def chooseEndpoint(heavy=False, labelService=False, exclude=()):
+    # Pick the endpoint with the best observed latency and error rate, that is not ejected and is under its rate limit
+    # Heavy aggregation queries prefer unthrottled mirrors, if any of them is available and its last query didn't fail
+    # exclude - names of endpoints that already failed this query, used only while there are other endpoints to choose from
+    candidates = [e for e in SPARQL_ENDPOINTS if e['labelService'] or not labelService]
+    if not candidates:
+        raise Exception("None of the configured SPARQL endpoints support wikibase:label service")
+    candidates = [e for e in candidates if e['name'] not in exclude] or candidates
+    while True:
+        available = [e for e in candidates if endpointWaitTime(e) == 0]
+        if heavy:
+            unthrottled = [e for e in available if e['rateLimit'] == 0 and e['failures'] == 0]
+            if unthrottled:
+                available = unthrottled
+        if available:
+            return min(available, key=endpointScore)
+        # All endpoints are either ejected or reached their rate limit, so wait till the first one frees up
+        sleepTime = min(endpointWaitTime(e) for e in candidates)
+        logging.info("No SPARQL endpoint available, waiting for {:.0f}s".format(sleepTime))
+        time.sleep(sleepTime + 1)
+
+def ejectEndpoint(endpoint, seconds):
+    endpoint['ejectedUntil'] = max(endpoint['ejectedUntil'], time.time() + seconds)
+    logging.info("Endpoint {} taken out of the pool for {}s".format(endpoint['name'], seconds))
+
+def recordEndpointResult(endpoint, latency, failed, timedOut=False):
+    # Keep exponential moving averages of endpoint latency and error rate, used for routing queries
+    # Query timeouts only raise the error rate, heavy batches are expected to time out sometimes even on a healthy endpoint,
+    # so they don't count towards failures in a row, that take the endpoint out of the pool
+    alpha = 0.2
+    endpoint['errorRate'] = (1 - alpha) * endpoint['errorRate'] + (alpha if failed or timedOut else 0)
+    if timedOut:
+        return
+    if failed:
+        endpoint['failures'] = endpoint['failures'] + 1
+        if endpoint['failures'] >= ENDPOINT_MAX_FAILURES:
+            logging.warning("Endpoint {} failed {} times in a row".format(endpoint['name'], ENDPOINT_MAX_FAILURES))
+            ejectEndpoint(endpoint, ENDPOINT_EJECT_TIME)
+            endpoint['failures'] = 0
+    else:
+        endpoint['failures'] = 0
+        if endpoint['latency'] is None:
+            endpoint['latency'] = latency
+        else:
+            endpoint['latency'] = (1 - alpha) * endpoint['latency'] + alpha * latency
+
+def queryWikiData(query, retries=0, heavy=False, labelService=False, failedEndpoints=()):
+    # Make POST request to one of the configured SPARQL endpoints
+    # heavy - query is a large aggregation, so prefer unthrottled mirrors
+    # labelService - query uses wikibase:label service, which not all of the mirrors support
+    # failedEndpoints - names of endpoints this query already failed on, retries go to other endpoints if there are any
+    # Returns result rows as tuples, in the order of the SELECT variables
     if retries == 3:
         # TODO - Currently there is a problem, that a failing query even if it was because of too many requests,
         # the failing query will go into an endless fail loop
         logging.warning("Bad requests loop skipping query for now - {}".format(query))
-        return {}
-    # 'Wikidata schema extraction Bot/1.0 (https://github.com/vehiginters/wikidata_export, vehiginters@gmail.com)'
-    url = 'https://query.wikidata.org/sparql'
-    body = {'query': query,
-            'format': 'json',}
-    # Proper user-agent to identify the caller as specified by WikiData query API specification
-    headers = { 'User-Agent': 'Wikidata schema extraction Bot/1.0 (https://github.com/vehiginters/wikidata_export, vehiginters@gmail.com)'}
-    LAST_MINUTE_EVENTS.append(time.time())
-    response = requests.post(url, headers = headers, data = body)
+        return ()
+    endpoint = chooseEndpoint(heavy, labelService, failedEndpoints)
+    failedEndpoints = failedEndpoints + (endpoint['name'],)
+    body = {'query': addQueryPrefixes(query)}
+    endpoint['events'].append(time.time())
+    startTime = time.time()
+    try:
+        response = getEndpointSession(endpoint).post(endpoint['url'], data = body)
+    except requests.exceptions.RequestException as error:
+        logging.warning("Request to endpoint {} failed - {}".format(endpoint['name'], error))
+        recordEndpointResult(endpoint, time.time() - startTime, True)
+        return queryWikiData(query, retries+1, heavy, labelService, failedEndpoints)
     if response.ok:
-        logging.debug("Succesful query - {}".format(query))
-        return json.loads(response.text)['results']['bindings']
-    elif response.status_code == 429 or response.status_code == 503 : # To many requests in the last minute, let's wait some time till we make a new one
+        logging.debug("Succesful query on {} - {}".format(endpoint['name'], query))
+        recordEndpointResult(endpoint, time.time() - startTime, False)
+        return parseCsvRows(response.content)
+    elif response.status_code == 429 or response.status_code == 503 : # To many requests in the last minute, take the endpoint out of the pool for a while
         sleepTime = 60
         if "Retry-After" in response.headers:
             sleepTime = int(response.headers["Retry-After"])
-        logging.info("Query Limit reached. Retrying after {}s".format(sleepTime))
-        time.sleep(sleepTime+1)
-        queryWikiData(query, retries+1)
-    # TO-DO failed queries should be logged, not printed out in stdout
+        logging.info("Query Limit reached on {}. Retrying after {}s".format(endpoint['name'], sleepTime))
+        ejectEndpoint(endpoint, sleepTime+1)
+        return queryWikiData(query, retries+1, heavy, labelService, failedEndpoints)
     elif response.status_code == 502: # Bad gateway server, let's just retry the query
-        logging.info("Got bad gateway server in response, retrying query...")
-        time.sleep(30)
-        queryWikiData(query, retries+1)
+        logging.info("Got bad gateway server in response from {}, retrying query...".format(endpoint['name']))
+        recordEndpointResult(endpoint, time.time() - startTime, True)
+        ejectEndpoint(endpoint, 30)
+        return queryWikiData(query, retries+1, heavy, labelService, failedEndpoints)
     elif response.status_code == 500: # Query timeout, can't do much about this besides skipping
-        logging.warning("Query timed out, skipping query - {}".format(query))
-        return {}
+        # Lowers the endpoint score, but doesn't take it out of the pool
+        recordEndpointResult(endpoint, time.time() - startTime, False, timedOut=True)
+        logging.warning("Query timed out on {}, skipping query - {}".format(endpoint['name'], query))
+        return ()
     else:
-        logging.warning("WikiData returned response code - {}".format(response.status_code))
+        recordEndpointResult(endpoint, time.time() - startTime, True)
+        logging.warning("Endpoint {} returned response code - {}".format(endpoint['name'], response.status_code))
         logging.warning("Failed query - {}".format(query))
 
+# In preview mode relations are inserted with approximate counts, and marked in 'data' column,
+# so that a later full export into the same schema can replace them
+PREVIEW_MODE = False
+PREVIEW_MARK = '{"preview": true}'
+def relationData():
+    return "'{}'::jsonb".format(PREVIEW_MARK) if PREVIEW_MODE else "NULL"
+
+def tableHasRows(cursor, table):
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM {schema}.{table})".format(schema = SCHEMA, table = table))
+    return cursor.fetchone()[0]
+
+def removeRefinedPreviewRelations(cursor):
+    # Delete preview relations of classes, for which the full export has already inserted relations of the same type
+    # Runs in the same transaction as the full export inserts, so readers see either preview or full relations
+    baseSql = '''
+        DELETE FROM {schema}.{table} p
+        WHERE p.data @> '{mark}'
+        AND EXISTS (SELECT 1 FROM {schema}.{table} f
+            WHERE f.{classColumn} = p.{classColumn} AND f.type_id = p.type_id
+            AND (f.data IS NULL OR NOT f.data @> '{mark}'));
+    '''
+    cursor.execute(baseSql.format(schema = SCHEMA, table = 'cp_rels', classColumn = 'class_id', mark = PREVIEW_MARK))
+    cursor.execute(baseSql.format(schema = SCHEMA, table = 'cc_rels', classColumn = 'class_1_id', mark = PREVIEW_MARK))
+
+@profileStage
 def insertClasses(connection, dict):
     # Insert classes from given dictionary into target database
     cur = connection.cursor()
@@ -185,6 +476,14 @@ def insertClasses(connection, dict):
         INSERT INTO {schema}.classes(ns_id, iri, cnt, display_name, local_name, is_unique)
         SELECT (SELECT id FROM {schema}.ns WHERE name = '{prefix}') AS ns_id,
         '{iri}', {instances}, '{label}', '{localName}', true;\n'''
+    if tableHasRows(cur, 'classes'):
+        # Refining a schema, that already has classes (for example from preview), so update existing classes instead of duplicating them
+        baseSql = '''
+            WITH updated AS (UPDATE {schema}.classes SET cnt = {instances}, display_name = '{label}' WHERE iri = '{iri}' RETURNING id)
+            INSERT INTO {schema}.classes(ns_id, iri, cnt, display_name, local_name, is_unique)
+            SELECT (SELECT id FROM {schema}.ns WHERE name = '{prefix}') AS ns_id,
+            '{iri}', {instances}, '{label}', '{localName}', true
+            WHERE NOT EXISTS (SELECT 1 FROM updated);\n'''
     totalSql = ""
     i = 0
     totalClasses = len(dict)
@@ -203,6 +502,7 @@ def insertClasses(connection, dict):
     connection.commit()
     cur.close()
 
+@profileStage
 def insertProperties(connection, dict):
     # Insert properties from given dictionary into target database
     cur = connection.cursor()
@@ -210,6 +510,14 @@ def insertProperties(connection, dict):
         INSERT INTO {schema}.properties(ns_id, iri, cnt, display_name, local_name, object_cnt)
         SELECT (SELECT id FROM {schema}.ns WHERE name = '{prefix}') AS ns_id,
         '{iri}', {cnt}, '{label}', '{localName}', {objCount};\n'''
+    if tableHasRows(cur, 'properties'):
+        # Same as for classes, update already existing properties
+        baseSql = '''
+            WITH updated AS (UPDATE {schema}.properties SET cnt = {cnt}, display_name = '{label}', object_cnt = {objCount} WHERE iri = '{iri}' RETURNING id)
+            INSERT INTO {schema}.properties(ns_id, iri, cnt, display_name, local_name, object_cnt)
+            SELECT (SELECT id FROM {schema}.ns WHERE name = '{prefix}') AS ns_id,
+            '{iri}', {cnt}, '{label}', '{localName}', {objCount}
+            WHERE NOT EXISTS (SELECT 1 FROM updated);\n'''
     totalSql = ""
     i = 0
     totalProperties = len(dict)
@@ -236,12 +544,13 @@ def insertClassPropertyRelations(cursor, relationList, outgoingRelations):
     # As the Python script has no idea about IDs of the classes, just tell the SQL to select them based on class and property iri's
     # Should watch out, as the iri technically could not be unique, as that could brake this SQL
     baseSql = '''
-        INSERT INTO {schema}.cp_rels(class_id, property_id, type_id, cnt, object_cnt)
+        INSERT INTO {schema}.cp_rels(class_id, property_id, type_id, cnt, object_cnt, data)
         SELECT (SELECT id from {schema}.classes WHERE iri = '{classIri}') AS cl_id,
         (SELECT id from {schema}.properties WHERE iri = '{propIri}') AS pr_id,
         (SELECT id from {schema}.cp_rel_types WHERE name = '{propertyDirection}'),
         {cnt},
-        {objectCnt}
+        {objectCnt},
+        {data}
         HAVING (SELECT id from {schema}.classes WHERE iri = '{classIri}') IS NOT NULL
         AND (SELECT id from {schema}.properties WHERE iri = '{propIri}') IS NOT NULL;
     '''
@@ -252,7 +561,7 @@ def insertClassPropertyRelations(cursor, relationList, outgoingRelations):
     i = 0
     for class1, propery, cnt, objectCnt  in relationList:
         i = i + 1
-        totalSql = totalSql + baseSql.format(schema = SCHEMA, classIri = class1, propIri = propery, propertyDirection = propertyDirectionString, cnt = cnt, objectCnt = objectCnt)
+        totalSql = totalSql + baseSql.format(schema = SCHEMA, classIri = class1, propIri = propery, propertyDirection = propertyDirectionString, cnt = cnt, objectCnt = objectCnt, data = relationData())
         if ((i % 50000) == 0) or (i == totalRelations):
             cursor.execute(totalSql)
             totalSql = ""
@@ -260,12 +569,13 @@ def insertClassPropertyRelations(cursor, relationList, outgoingRelations):
 def insertConstraintRelations(cursor, constraintList):
     # Insert class and property constraint relations into target database
     baseSql = '''
-        INSERT INTO {schema}.cp_rels(class_id, property_id, type_id, cnt, object_cnt)
+        INSERT INTO {schema}.cp_rels(class_id, property_id, type_id, cnt, object_cnt, data)
         SELECT (SELECT id from {schema}.classes WHERE iri = '{classIri}') AS cl_id,
         (SELECT id from {schema}.properties WHERE iri = '{propIri}') AS pr_id,
         (SELECT id from {schema}.cp_rel_types WHERE name = '{constraintType}'),
         {cnt},
-        {objectCnt}
+        {objectCnt},
+        {data}
         HAVING (SELECT id from {schema}.classes WHERE iri = '{classIri}') IS NOT NULL
         AND (SELECT id from {schema}.properties WHERE iri = '{propIri}') IS NOT NULL;
     '''
@@ -284,7 +594,7 @@ def insertConstraintRelations(cursor, constraintList):
     for cl, prop, constrType in constraintList:
         i = i + 1
         constr = 'type_constraint' if constrType == 11 else 'value_type_constraint'
-        totalSql = totalSql + baseSql.format(schema = SCHEMA, classIri = cl, propIri = prop, constraintType = constr, cnt = 0, objectCnt = 0)
+        totalSql = totalSql + baseSql.format(schema = SCHEMA, classIri = cl, propIri = prop, constraintType = constr, cnt = 0, objectCnt = 0, data = relationData())
         if ((i % 50000) == 0) or (i == totalConstraints):
             cursor.execute(totalSql)
             totalSql = ""
@@ -313,10 +623,11 @@ def insertClassClassRelations(cursor, relationList):
     # As the Python script has no idea about IDs of the classes, just tell the SQL to select them based on class and property iri's
     # Should watch out, as the iri technically could not be unique, as that could brake this SQL
     baseSql = '''
-        INSERT INTO {schema}.cc_rels(class_1_id, class_2_id, type_id)
+        INSERT INTO {schema}.cc_rels(class_1_id, class_2_id, type_id, data)
         SELECT (SELECT id from {schema}.classes WHERE iri = '{class1Iri}') AS cl_id,
         (SELECT id from {schema}.classes WHERE iri = '{class2Iri}') AS cl2_id,
-        (SELECT id from {schema}.cc_rel_types WHERE name = 'sub_class_of')
+        (SELECT id from {schema}.cc_rel_types WHERE name = 'sub_class_of'),
+        {data}
         HAVING (SELECT id from {schema}.classes WHERE iri = '{class1Iri}') IS NOT NULL
         AND (SELECT id from {schema}.classes WHERE iri = '{class2Iri}') IS NOT NULL;
     '''
@@ -324,13 +635,70 @@ def insertClassClassRelations(cursor, relationList):
     totalRelations = len(relationList)
     i = 0
     for class1, class2  in relationList:
-        totalSql = totalSql + baseSql.format(schema = SCHEMA, class1Iri = class1, class2Iri = class2)
+        totalSql = totalSql + baseSql.format(schema = SCHEMA, class1Iri = class1, class2Iri = class2, data = relationData())
         if ((i % 50000) == 0) or (i == totalRelations):
             cursor.execute(totalSql)
             totalSql = ""
     # Don't commit transaction just yet, because these relations are inserted in batches and not all at once
 
+def insertPropertyPropertyRelations(cursor, relationList):
+    # Insert property co-occurrence relations, properties are selected based on iri's same as for class relations
+    baseSql = '''
+        INSERT INTO {schema}.pp_rels(property_1_id, property_2_id, type_id, cnt)
+        SELECT (SELECT id from {schema}.properties WHERE iri = '{prop1Iri}') AS pr1_id,
+        (SELECT id from {schema}.properties WHERE iri = '{prop2Iri}') AS pr2_id,
+        (SELECT id from {schema}.pp_rel_types WHERE name = 'common_subject'),
+        {cnt}
+        HAVING (SELECT id from {schema}.properties WHERE iri = '{prop1Iri}') IS NOT NULL
+        AND (SELECT id from {schema}.properties WHERE iri = '{prop2Iri}') IS NOT NULL;
+    '''
+    totalSql = ""
+    totalRelations = len(relationList)
+    logging.info("Inserting {} property co-occurrence relations into target database...".format(totalRelations))
+    i = 0
+    for prop1, prop2, cnt in relationList:
+        i = i + 1
+        totalSql = totalSql + baseSql.format(schema = SCHEMA, prop1Iri = prop1, prop2Iri = prop2, cnt = cnt)
+        if ((i % 50000) == 0) or (i == totalRelations):
+            cursor.execute(totalSql)
+            totalSql = ""
+
+def getClassPropertyPairs(cursor):
+    # Outgoing class property relations with objects, as (cp_rels id, class iri, property iri, object count)
+    baseSql = '''
+        SELECT cp.id, c.iri, p.iri, cp.object_cnt
+        FROM {schema}.cp_rels cp
+        JOIN {schema}.classes c ON c.id = cp.class_id
+        JOIN {schema}.properties p ON p.id = cp.property_id
+        WHERE cp.type_id = (SELECT id from {schema}.cp_rel_types WHERE name = 'outgoing')
+        AND cp.object_cnt > 0
+        ORDER BY cp.class_id;
+    '''
+    cursor.execute(baseSql.format(schema = SCHEMA))
+    return cursor.fetchall()
+
+def insertClassPropertyClassRelations(cursor, relationList):
+    # Bulk load class property class relations, rows are copied into a temporary table
+    # and other classes are resolved to ids with a single join instead of a subselect per row
+    logging.info("Inserting {} class property class relations into target database...".format(len(relationList)))
+    cursor.execute("CREATE TEMPORARY TABLE IF NOT EXISTS cpc_rels_load(cp_rel_id integer, other_class_iri text, cnt integer);")
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for cpRelId, otherClass, cnt in relationList:
+        # Same as for properties, keep the count in 'cnt' column integer range
+        writer.writerow((cpRelId, otherClass, min(cnt, 2100000000)))
+    buffer.seek(0)
+    cursor.copy_expert("COPY cpc_rels_load(cp_rel_id, other_class_iri, cnt) FROM STDIN WITH (FORMAT csv)", buffer)
+    baseSql = '''
+        INSERT INTO {schema}.cpc_rels(cp_rel_id, other_class_id, cnt)
+        SELECT l.cp_rel_id, c.id, l.cnt
+        FROM cpc_rels_load l
+        JOIN {schema}.classes c ON c.iri = l.other_class_iri;
+        TRUNCATE cpc_rels_load;
+    '''
+    cursor.execute(baseSql.format(schema = SCHEMA))
 
+@profileStage
 def insertPropObjCount(connection, propDict):
     # Update property object count in target database
     baseSql = '''
@@ -352,7 +720,418 @@ def insertPropObjCount(connection, propDict):
     connection.commit()
     cur.close()
 
-def getProperties():
+class PostgreSqlSink:
+    # Writes extracted data straight into target PostgreSQL database
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.cursor()
+
+    def insertWikidataPrefixes(self):
+        insertWikidataPrefixes(self.connection)
+
+    def insertClasses(self, classDict):
+        insertClasses(self.connection, classDict)
+
+    def insertProperties(self, propDict):
+        insertProperties(self.connection, propDict)
+
+    def insertPropObjCount(self, propObjCountDict):
+        insertPropObjCount(self.connection, propObjCountDict)
+
+    def insertClassPropertyRelations(self, relationList, outgoingRelations):
+        insertClassPropertyRelations(self.cursor, relationList, outgoingRelations)
+
+    def updateClassPropertyRelations(self, relationList):
+        updateClassPropertyRelations(self.cursor, relationList)
+
+    def insertClassClassRelations(self, relationList):
+        insertClassClassRelations(self.cursor, relationList)
+
+    def insertConstraintRelations(self, constraintList):
+        insertConstraintRelations(self.cursor, constraintList)
+
+    def insertPropertyPropertyRelations(self, relationList):
+        insertPropertyPropertyRelations(self.cursor, relationList)
+
+    def getClassPropertyPairs(self):
+        return getClassPropertyPairs(self.cursor)
+
+    def insertClassPropertyClassRelations(self, relationList):
+        insertClassPropertyClassRelations(self.cursor, relationList)
+
+    def commit(self):
+        if not PREVIEW_MODE:
+            removeRefinedPreviewRelations(self.cursor)
+        self.connection.commit()
+
+    def close(self):
+        self.cursor.close()
+        self.connection.close()
+
+# Relation type ids used in snapshots, same as in the sample schema
+CP_REL_TYPE_IDS = {'incoming': 1, 'outgoing': 2, 'type_constraint': 11, 'value_type_constraint': 12}
+CC_REL_TYPE_IDS = {'sub_class_of': 1}
+PP_REL_TYPE_IDS = {'common_subject': 2}
+# Column types of snapshot tables, ns_name is resolved to ns_id only while importing
+SNAPSHOT_COLUMNS = {
+    'classes': [('id', 'int32'), ('iri', 'string'), ('cnt', 'int64'), ('display_name', 'string'), ('local_name', 'string'), ('ns_name', 'string')],
+    'properties': [('id', 'int32'), ('iri', 'string'), ('cnt', 'int64'), ('display_name', 'string'), ('local_name', 'string'), ('ns_name', 'string'), ('object_cnt', 'int64')],
+    'cp_rels': [('id', 'int32'), ('class_id', 'int32'), ('property_id', 'int32'), ('type_id', 'int32'), ('cnt', 'int64'), ('object_cnt', 'int64')],
+    'cp_rels_object_cnt': [('class_id', 'int32'), ('property_id', 'int32'), ('type_id', 'int32'), ('new_object_cnt', 'int64')],
+    'cc_rels': [('id', 'int32'), ('class_1_id', 'int32'), ('class_2_id', 'int32'), ('type_id', 'int32')],
+    'pp_rels': [('id', 'int32'), ('property_1_id', 'int32'), ('property_2_id', 'int32'), ('type_id', 'int32'), ('cnt', 'int64')],
+    'cpc_rels': [('id', 'int32'), ('cp_rel_id', 'int32'), ('other_class_id', 'int32'), ('cnt', 'int32')],
+}
+def snapshotSchema(table):
+    return pyarrow.schema([(name, pyarrow.type_for_alias(columnType)) for name, columnType in SNAPSHOT_COLUMNS[table]])
+
+class ParquetSink:
+    # Writes extracted data into compressed Parquet files with integer ids, one file per target table
+    # Snapshot can be loaded into target PostgreSQL schema later with importSnapshot
+    def __init__(self, directory, compression='zstd'):
+        if pyarrow is None:
+            raise Exception("Parquet sink requires pyarrow library")
+        self.directory = directory
+        self.compression = compression
+        os.makedirs(directory, exist_ok=True)
+        self.writers = {}
+        self.classIds = {}
+        # Properties are kept in memory till the end, as their object count is updated after they are inserted
+        self.properties = {}
+        self.nextCpRelId = 1
+        self.nextCcRelId = 1
+        self.nextPpRelId = 1
+        self.nextCpcRelId = 1
+
+    def writeRows(self, table, columns):
+        # Append rows given as dict of column lists to the table file
+        if not columns[SNAPSHOT_COLUMNS[table][0][0]]:
+            return
+        if table not in self.writers:
+            fileName = table + ('.staging.parquet' if table.startswith('cp_rels') else '.parquet')
+            self.writers[table] = pyarrow.parquet.ParquetWriter(os.path.join(self.directory, fileName),
+                snapshotSchema(table), compression=self.compression)
+        self.writers[table].write_table(pyarrow.table(columns, schema=snapshotSchema(table)))
+
+    def insertWikidataPrefixes(self):
+        # Prefixes are added to the target database by importSnapshot
+        pass
+
+    def insertClasses(self, classDict):
+        columns = {name: [] for name, columnType in SNAPSHOT_COLUMNS['classes']}
+        logging.info("Writing {} classes into snapshot".format(len(classDict)))
+        for key, value in classDict.items():
+            classId = len(self.classIds) + 1
+            self.classIds[key] = classId
+            prefix, localName = parseIri(key)
+            columns['id'].append(classId)
+            columns['iri'].append(key)
+            columns['cnt'].append(int(value['instances']))
+            columns['display_name'].append(value['label'])
+            columns['local_name'].append(localName)
+            columns['ns_name'].append(prefix)
+        self.writeRows('classes', columns)
+
+    def insertProperties(self, propDict):
+        for key, value in propDict.items():
+            prefix, localName = parseIri(key)
+            # Same as for database, put the use count at the limit of properties table 'cnt' column integer range
+            self.properties[key] = {'id': len(self.properties) + 1, 'cnt': min(value['useCount'], 2100000000),
+                'display_name': value['label'], 'local_name': localName, 'ns_name': prefix, 'object_cnt': int(value['objCount'])}
+
+    def insertPropObjCount(self, propObjCountDict):
+        for key, value in propObjCountDict.items():
+            if key in self.properties:
+                self.properties[key]['object_cnt'] = int(value)
+
+    def insertClassPropertyRelations(self, relationList, outgoingRelations):
+        typeId = CP_REL_TYPE_IDS['outgoing' if outgoingRelations else 'incoming']
+        self.writeClassPropertyRelations([(class1, prop, typeId, cnt, objectCnt) for class1, prop, cnt, objectCnt in relationList])
+
+    def insertConstraintRelations(self, constraintList):
+        self.writeClassPropertyRelations([(cl, prop, constrType, 0, 0) for cl, prop, constrType in constraintList])
+
+    def writeClassPropertyRelations(self, relationList):
+        # Same as for database, relations with classes or properties not in the snapshot are skipped
+        columns = {name: [] for name, columnType in SNAPSHOT_COLUMNS['cp_rels']}
+        logging.info("Writing {} class property relations into snapshot...".format(len(relationList)))
+        for class1, prop, typeId, cnt, objectCnt in relationList:
+            if class1 not in self.classIds or prop not in self.properties:
+                continue
+            columns['id'].append(self.nextCpRelId)
+            columns['class_id'].append(self.classIds[class1])
+            columns['property_id'].append(self.properties[prop]['id'])
+            columns['type_id'].append(typeId)
+            columns['cnt'].append(cnt)
+            columns['object_cnt'].append(objectCnt)
+            self.nextCpRelId = self.nextCpRelId + 1
+        self.writeRows('cp_rels', columns)
+
+    def updateClassPropertyRelations(self, relationList):
+        # Object count updates are written aside and merged into cp_rels when the snapshot is closed
+        columns = {name: [] for name, columnType in SNAPSHOT_COLUMNS['cp_rels_object_cnt']}
+        for class1, prop, objectCnt in relationList:
+            if class1 not in self.classIds or prop not in self.properties:
+                continue
+            columns['class_id'].append(self.classIds[class1])
+            columns['property_id'].append(self.properties[prop]['id'])
+            columns['type_id'].append(CP_REL_TYPE_IDS['outgoing'])
+            columns['new_object_cnt'].append(objectCnt)
+        self.writeRows('cp_rels_object_cnt', columns)
+
+    def insertClassClassRelations(self, relationList):
+        columns = {name: [] for name, columnType in SNAPSHOT_COLUMNS['cc_rels']}
+        logging.info("Writing {} class relations into snapshot".format(len(relationList)))
+        for class1, class2 in relationList:
+            if class1 not in self.classIds or class2 not in self.classIds:
+                continue
+            columns['id'].append(self.nextCcRelId)
+            columns['class_1_id'].append(self.classIds[class1])
+            columns['class_2_id'].append(self.classIds[class2])
+            columns['type_id'].append(CC_REL_TYPE_IDS['sub_class_of'])
+            self.nextCcRelId = self.nextCcRelId + 1
+        self.writeRows('cc_rels', columns)
+
+    def insertPropertyPropertyRelations(self, relationList):
+        columns = {name: [] for name, columnType in SNAPSHOT_COLUMNS['pp_rels']}
+        logging.info("Writing {} property co-occurrence relations into snapshot".format(len(relationList)))
+        for prop1, prop2, cnt in relationList:
+            if prop1 not in self.properties or prop2 not in self.properties:
+                continue
+            columns['id'].append(self.nextPpRelId)
+            columns['property_1_id'].append(self.properties[prop1]['id'])
+            columns['property_2_id'].append(self.properties[prop2]['id'])
+            columns['type_id'].append(PP_REL_TYPE_IDS['common_subject'])
+            columns['cnt'].append(cnt)
+            self.nextPpRelId = self.nextPpRelId + 1
+        self.writeRows('pp_rels', columns)
+
+    def commit(self):
+        # Rows are already written to files, when they are inserted
+        pass
+
+    def close(self):
+        columns = {name: [] for name, columnType in SNAPSHOT_COLUMNS['properties']}
+        for key, value in self.properties.items():
+            columns['iri'].append(key)
+            for name in value:
+                columns[name].append(value[name])
+        self.writeRows('properties', columns)
+        for writer in self.writers.values():
+            writer.close()
+        self.writers.clear()
+        self.mergeObjectCountUpdates()
+        logging.info("Snapshot written to {}".format(self.directory))
+
+    def mergeObjectCountUpdates(self):
+        # Merge the staged relations and object count updates into cp_rels, leaving exactly one file per target table
+        # Can be called more than once, later staged relations are appended to already merged ones
+        cpRelsFile = os.path.join(self.directory, 'cp_rels.parquet')
+        stagingFile = os.path.join(self.directory, 'cp_rels.staging.parquet')
+        updatesFile = os.path.join(self.directory, 'cp_rels_object_cnt.staging.parquet')
+        if not os.path.exists(stagingFile) and not os.path.exists(updatesFile):
+            return
+        cpRels = pyarrow.concat_tables([pyarrow.parquet.read_table(fileName) for fileName in (cpRelsFile, stagingFile)
+            if os.path.exists(fileName)] or [snapshotSchema('cp_rels').empty_table()])
+        if os.path.exists(updatesFile):
+            keys = ['class_id', 'property_id', 'type_id']
+            updates = pyarrow.parquet.read_table(updatesFile).group_by(keys).aggregate([('new_object_cnt', 'max')])
+            cpRels = cpRels.join(updates, keys=keys, join_type='left outer')
+            objectCnt = pyarrow.compute.coalesce(cpRels['new_object_cnt_max'], cpRels['object_cnt'])
+            cpRels = cpRels.set_column(cpRels.schema.get_field_index('object_cnt'), 'object_cnt', objectCnt)
+            cpRels = cpRels.select([name for name, columnType in SNAPSHOT_COLUMNS['cp_rels']]).sort_by('id')
+            os.remove(updatesFile)
+        pyarrow.parquet.write_table(cpRels, cpRelsFile, compression=self.compression)
+        if os.path.exists(stagingFile):
+            os.remove(stagingFile)
+
+    def getClassPropertyPairs(self):
+        # Outgoing class property relations with objects, as (cp_rels id, class iri, property iri, object count)
+        # Relations written so far are merged first, so that their object counts are final
+        for table in ('cp_rels', 'cp_rels_object_cnt'):
+            if table in self.writers:
+                self.writers.pop(table).close()
+        self.mergeObjectCountUpdates()
+        cpRelsFile = os.path.join(self.directory, 'cp_rels.parquet')
+        if not os.path.exists(cpRelsFile):
+            return []
+        cpRels = pyarrow.parquet.read_table(cpRelsFile, columns=['id', 'class_id', 'property_id', 'type_id', 'object_cnt'])
+        cpRels = cpRels.filter(pyarrow.compute.and_(
+            pyarrow.compute.equal(cpRels['type_id'], CP_REL_TYPE_IDS['outgoing']),
+            pyarrow.compute.greater(cpRels['object_cnt'], 0)))
+        classIris = {classId: key for key, classId in self.classIds.items()}
+        propIris = {value['id']: key for key, value in self.properties.items()}
+        return [(cpRelId, classIris[classId], propIris[propId], objectCnt) for cpRelId, classId, propId, objectCnt in zip(
+            cpRels['id'].to_pylist(), cpRels['class_id'].to_pylist(), cpRels['property_id'].to_pylist(), cpRels['object_cnt'].to_pylist())]
+
+    def insertClassPropertyClassRelations(self, relationList):
+        columns = {name: [] for name, columnType in SNAPSHOT_COLUMNS['cpc_rels']}
+        logging.info("Writing {} class property class relations into snapshot".format(len(relationList)))
+        for cpRelId, otherClass, cnt in relationList:
+            if otherClass not in self.classIds:
+                continue
+            columns['id'].append(self.nextCpcRelId)
+            columns['cp_rel_id'].append(cpRelId)
+            columns['other_class_id'].append(self.classIds[otherClass])
+            # Same as in database, keep the count in int32 'cnt' column range
+            columns['cnt'].append(min(cnt, 2100000000))
+            self.nextCpcRelId = self.nextCpcRelId + 1
+        self.writeRows('cpc_rels', columns)
+
+def getSink():
+    # Target for the extracted data, set in config [output] section, PostgreSQL database by default
+    outputConfig = config('output')
+    sinkName = outputConfig.get('sink', 'postgresql') if outputConfig else 'postgresql'
+    if sinkName == 'postgresql':
+        return PostgreSqlSink(getDbCon())
+    elif sinkName == 'parquet':
+        directory = os.path.join(outputConfig.get('directory', 'snapshots'), time.strftime("%Y%m%d%H%M", time.localtime()))
+        return ParquetSink(directory, outputConfig.get('compression', 'zstd'))
+    raise Exception("Invalid output sink({}), valid sinks(postgresql,parquet)".format(sinkName))
+
+def importSnapshot(connection, directory):
+    # Bulk load Parquet snapshot into the target schema with COPY, keeping the snapshot ids
+    # Target tables should be empty, as ids are not remapped
+    if pyarrow is None:
+        raise Exception("Importing snapshots requires pyarrow library")
+    insertWikidataPrefixes(connection)
+    cur = connection.cursor()
+    relTypeSql = """
+        INSERT INTO {schema}.cp_rel_types(id, name) VALUES({id},'{name}')
+             ON CONFLICT (id)
+             DO NOTHING;
+    """
+    for name in ('type_constraint', 'value_type_constraint'):
+        cur.execute(relTypeSql.format(schema = SCHEMA, id = CP_REL_TYPE_IDS[name], name = name))
+    cur.execute("SELECT name, id FROM {schema}.ns".format(schema = SCHEMA))
+    nsRows = cur.fetchall()
+    nsNames = pyarrow.array([row[0] for row in nsRows], pyarrow.string())
+    nsIds = pyarrow.array([row[1] for row in nsRows], pyarrow.int32())
+    csvOptions = pyarrow.csv.WriteOptions(include_header=False)
+    for table in ('classes', 'properties', 'cp_rels', 'cc_rels', 'pp_rels', 'cpc_rels'):
+        fileName = os.path.join(directory, table + '.parquet')
+        if not os.path.exists(fileName):
+            logging.warning("Snapshot has no {} file, skipping".format(table))
+            continue
+        parquetFile = pyarrow.parquet.ParquetFile(fileName)
+        logging.info("Importing {} {} rows...".format(parquetFile.metadata.num_rows, table))
+        for batch in parquetFile.iter_batches(batch_size=200000):
+            if 'ns_name' in batch.schema.names:
+                # Resolve prefix names to ns ids of the target database
+                names = [name for name in batch.schema.names if name != 'ns_name']
+                arrays = [batch[name] for name in names]
+                names.append('ns_id')
+                arrays.append(pyarrow.compute.take(nsIds, pyarrow.compute.index_in(batch['ns_name'], value_set=nsNames)))
+                if table == 'classes':
+                    # Same as insertClasses
+                    names.append('is_unique')
+                    arrays.append(pyarrow.array([True] * batch.num_rows))
+                batch = pyarrow.RecordBatch.from_arrays(arrays, names=names)
+            buffer = io.BytesIO()
+            pyarrow.csv.write_csv(batch, buffer, csvOptions)
+            buffer.seek(0)
+            cur.copy_expert("COPY {schema}.{table} ({columns}) FROM STDIN WITH (FORMAT csv)".format(
+                schema = SCHEMA, table = table, columns = ", ".join(batch.schema.names)), buffer)
+        # Move the id sequence past imported ids, so later inserts don't collide
+        cur.execute("SELECT setval('{schema}.{table}_id_seq', (SELECT COALESCE(MAX(id), 0) + 1 FROM {schema}.{table}), false)".format(
+            schema = SCHEMA, table = table))
+    connection.commit()
+    cur.close()
+
+# Batch planner settings for class batched queries, cost of a class is predicted as
+# instanceWeight * instances + subclassWeight * subclasses + classCost
+# Classes are packed into batches with at most 'budget' total cost and 'maxClasses' classes
+# Classes with more than 'maxInstances' instances time out, so they are skipped and left for processLargeClasses
+# For 'rankScaled' plans the cost also depends on class rank by instance count, see predictClassCost
+BATCH_PLANS = {
+    # Outgoing properties - batches of up to 200k instances, classes over 400k instances are skipped
+    'outgoing': {'instanceWeight': 1, 'subclassWeight': 0, 'classCost': 1, 'budget': 200000, 'maxClasses': 5000, 'maxInstances': 400000, 'rankScaled': 0},
+    # Incoming properties - classes over 2mil instances are skipped, and as class instance amount doesn't perfectly correlate to query time,
+    # lower ranked classes get smaller batches
+    'incoming': {'instanceWeight': 1, 'subclassWeight': 0, 'classCost': 0, 'budget': 1000000, 'maxClasses': 1000, 'maxInstances': 2000000, 'rankScaled': 1},
+    # Outgoing object count - batches of up to 400k instances, classes over 400k instances are skipped
+    'objectCount': {'instanceWeight': 1, 'subclassWeight': 0, 'classCost': 1, 'budget': 400000, 'maxClasses': 5000, 'maxInstances': 400000, 'rankScaled': 0},
+    # Subclass relations - max 1mil result rows per query
+    'subclasses': {'instanceWeight': 0, 'subclassWeight': 1, 'classCost': 1, 'budget': 1000000, 'maxClasses': 15000, 'maxInstances': 0, 'rankScaled': 0},
+}
+def setBatchPlans():
+    # Batch plan settings can be overridden in config as <plan>_<setting>, for example incoming_budget=500000
+    plannerConfig = config('batchPlanner')
+    if not plannerConfig:
+        return
+    settingMap = {'instance_weight': 'instanceWeight', 'subclass_weight': 'subclassWeight', 'class_cost': 'classCost',
+                  'budget': 'budget', 'max_classes': 'maxClasses', 'max_instances': 'maxInstances', 'rank_scaled': 'rankScaled'}
+    for key, value in plannerConfig.items():
+        planName = next((name for name in BATCH_PLANS if key.startswith(name.lower() + '_')), None)
+        setting = settingMap.get(key[len(planName) + 1:]) if planName else None
+        if setting is None:
+            raise Exception("Invalid batchPlanner setting({})".format(key))
+        BATCH_PLANS[planName][setting] = float(value) if '.' in value else int(value)
+
+def predictClassCost(value, plan, rank):
+    cost = plan['instanceWeight'] * int(value['instances']) + plan['subclassWeight'] * int(value['subclasses']) + plan['classCost']
+    if plan['rankScaled']:
+        # For class with rank in [10^p, 10^(p+1)) batch can have at most budget/2^p instances and 10^p classes (max 'maxClasses'),
+        # so every class takes up its share of both of these limits. A batch of same ranked classes stays within both of them,
+        # and a mixed batch can't go over the sum of its classes shares
+        power = math.floor(math.log10(rank))
+        cost = cost * pow(2, power) + plan['budget'] / min(pow(10, power), plan['maxClasses'])
+    return cost
+
+def planClassBatches(classDict, planName):
+    # Bin-pack classes into batches with balanced predicted cost under the plan's cost budget
+    # Classes are placed from the most expensive one, each into the currently cheapest batch that still has room,
+    # and batches are returned most expensive first, so that parallel workers would finish at about the same time
+    # Returns list of (predicted cost, list of class iris) and list of skipped too large classes
+    plan = BATCH_PLANS[planName]
+    classCosts = []
+    skippedClasses = []
+    # Rank counts all classes in dictionary order (largest first), including the skipped ones
+    for rank, (key, value) in enumerate(classDict.items(), 1):
+        if plan['maxInstances'] and int(value['instances']) > plan['maxInstances']:
+            skippedClasses.append(key)
+            continue
+        classCosts.append((predictClassCost(value, plan, rank), key))
+    classCosts.sort(reverse=True)
+    totalCost = sum(cost for cost, key in classCosts)
+    batchCount = 0
+    if classCosts:
+        batchCount = max(math.ceil(totalCost / plan['budget']), math.ceil(len(classCosts) / plan['maxClasses']))
+    batches = [[] for idx in range(batchCount)]
+    batchCosts = [0] * batchCount
+    batchHeap = [(0, idx) for idx in range(batchCount)]
+    for cost, key in classCosts:
+        # Batches that already have max amount of classes are dropped from the heap
+        while batchHeap and len(batches[batchHeap[0][1]]) >= plan['maxClasses']:
+            heapq.heappop(batchHeap)
+        if batchHeap and (batchHeap[0][0] + cost <= plan['budget'] or not batches[batchHeap[0][1]]):
+            idx = heapq.heappop(batchHeap)[1]
+        else:
+            # Even the cheapest batch would go over the budget, so start a new one
+            idx = len(batches)
+            batches.append([])
+            batchCosts.append(0)
+        batches[idx].append(key)
+        batchCosts[idx] = batchCosts[idx] + cost
+        heapq.heappush(batchHeap, (batchCosts[idx], idx))
+    plannedBatches = sorted(((batchCosts[idx], batch) for idx, batch in enumerate(batches) if batch), key=lambda b: b[0], reverse=True)
+    return plannedBatches, skippedClasses
+
+def printBatchPlan(classDict):
+    # Print the batch count and predicted cost distribution for every class batched stage, without sending any batch queries
+    for planName, plan in BATCH_PLANS.items():
+        plannedBatches, skippedClasses = planClassBatches(classDict, planName)
+        costs = sorted(cost for cost, batch in plannedBatches)
+        print("{}: {} batches, {} skipped large classes, cost budget {}".format(planName, len(plannedBatches), len(skippedClasses), plan['budget']))
+        if costs:
+            print("    predicted cost total {}, min {}, median {}, mean {:.0f}, max {}".format(
+                sum(costs), costs[0], costs[len(costs) // 2], sum(costs) / len(costs), costs[-1]))
+            sizes = sorted(len(batch) for cost, batch in plannedBatches)
+            print("    classes per batch min {}, median {}, max {}".format(sizes[0], sizes[len(sizes) // 2], sizes[-1]))
+
+@profileStage
+def getProperties(limit=None):
+    # limit - get only the given number of most used properties
     logging.info("Getting list of properties...")
     query = """
         SELECT DISTINCT ?property (COUNT(?item) as ?useCount) WHERE {{
@@ -360,14 +1139,16 @@ def getProperties():
         }}
         GROUP BY ?property
         ORDER BY DESC(?useCount)
+        {limit}
     """
-    responseDict = queryWikiData(query)
+    responseRows = queryWikiData(query.format(limit="LIMIT {}".format(limit) if limit else ""), heavy=True)
     resultDict = {}
-    if responseDict is not None:
-        for i in responseDict:
-            resultDict[i['property']['value']] = {'useCount':int(i['useCount']['value']), 'label': "", 'objCount': 0}
+    if responseRows is not None:
+        for prop, useCount in responseRows:
+            resultDict[prop] = {'useCount':int(useCount), 'label': "", 'objCount': 0}
     return resultDict
 
+@profileStage
 def getPropertyLabels(propertiesDict):
     # Get labels for classes in a given dictionary
     totalProps = len(propertiesDict)
@@ -387,15 +1168,16 @@ def getPropertyLabels(propertiesDict):
         # Query wikidata in batches of 15000 to maximize query time and minimize amount of queries
         # Can't query in much bigger batches as then queries start to reach payload limit
         if ((i % 15000) == 0) or (i == totalProps):
-            responseDict = queryWikiData(query.format(propertyList))
-            if responseDict is not None:
-                for j in responseDict:
-                    if j['property']['value'] in propertiesDict:
-                        propertiesDict[j['property']['value']]['label'] = j['propLabel']['value']
+            responseRows = queryWikiData(query.format(propertyList), labelService=True)
+            if responseRows is not None:
+                for prop, propLabel in responseRows:
+                    if prop in propertiesDict:
+                        propertiesDict[prop]['label'] = propLabel
             propertyList = ""
             logging.info("{:.1%} done...".format(i/float(totalProps)))
 
-def getClassClassRelations(connection, classDict):
+@profileStage
+def getClassClassRelations(sink, classDict):
     logging.info("Getting Class-Class relations...")
     # A little complicated function, that gets all subclass relations between all relevant classes
     query = """
@@ -404,65 +1186,38 @@ def getClassClassRelations(connection, classDict):
           VALUES ?class {{ {} }}
         }}
     """
-    i = 0
-    relationsCounter = 0
-    totalClasses = len(classDict)
-    classList = ""
+    plannedBatches, skippedClasses = planClassBatches(classDict, 'subclasses')
+    totalBatches = len(plannedBatches)
     relationList = []
-    collectedClasses = 0
-    cur = connection.cursor()
     totalInsertedRelations = 0
-    # Iteration logic: for first iteration just take the class values and continue, for rest first check if to many subclasses collected and only after query collect the current class
-    # This is done so that we can kinda look at the number of subclasses for next class in dictionary
-    for key, value in classDict.items():
-        i = i + 1
-        if i == 1 or i == totalClasses:
-            collectedClasses = collectedClasses + 1
-            classList = classList + " <" + key + ">"
-            relationsCounter = relationsCounter + int(value['subclasses'])
-            if i == 1:
-                continue
-        # First check if either the max number of subclasses for collected classes go over 1mil, a total of 15000 classes is collected or if its the last class
-        if ((relationsCounter + int(value['subclasses'])) > 1000000) or (collectedClasses  == 15000) or (i == totalClasses):
-            # If either check is true, query wikidata to get related classes for batch of the collected classes
-            responseDict = queryWikiData(query.format(classList))
-            # It was a bit heavy to check if the subclass is relevant on wikidata, so it is done within Python
-            # But then again we get max 1mil of result rows in response, which can take up to 1GB RAM for a few secs, while the response is processed
-            if responseDict is not None:
-                for j in responseDict:
-                    if j['subclass']['value'] in classDict:
-                        relationList.append((j['class']['value'], j['subclass']['value']))
-                responseDict.clear() # Clear the response dict as fast as we can, to free up used memory
-            classList = ""
-            relationsCounter = 0
-            collectedClasses = 0
-            currentRelations = len(relationList)
-            logging.info("Relations for {}/{} classes done...".format(i, totalClasses))
-            # After we collect more then 50k relations, or we are at the end, insert the class relations, but dont commit the transaction yet
-            if (currentRelations > 50000) or (i == totalClasses):
-                insertClassClassRelations(cur, relationList)
-                totalInsertedRelations = totalInsertedRelations + currentRelations
-                logging.info("{} Class relations collected".format(totalInsertedRelations))
-                relationList.clear()
-        collectedClasses = collectedClasses + 1
-        classList = classList + " <" + key + ">"
-        relationsCounter = relationsCounter + int(value['subclasses'])
-    connection.commit()
-    cur.close()
+    for i, (batchCost, batch) in enumerate(plannedBatches, 1):
+        classList = " ".join("<" + key + ">" for key in batch)
+        # Query wikidata to get related classes for batch of the collected classes
+        responseRows = queryWikiData(query.format(classList), heavy=True)
+        # It was a bit heavy to check if the subclass is relevant on wikidata, so it is done within Python
+        # We get max 1mil of result rows in response, whole CSV response body is kept in memory until all of the rows are read,
+        # but rows are parsed one by one, so parsed rows are never all in memory at once
+        if responseRows is not None:
+            for cl, subclass in responseRows:
+                if subclass in classDict:
+                    relationList.append((cl, subclass))
+        currentRelations = len(relationList)
+        logging.info("Relations for {}/{} class batches done...".format(i, totalBatches))
+        # After we collect more then 50k relations, or we are at the end, insert the class relations, but dont commit the transaction yet
+        if (currentRelations > 50000) or (i == totalBatches):
+            sink.insertClassClassRelations(relationList)
+            totalInsertedRelations = totalInsertedRelations + currentRelations
+            logging.info("{} Class relations collected".format(totalInsertedRelations))
+            relationList.clear()
+    sink.commit()
 
-def getClassPropertyRelations(connection, classDict, outgoingRelations=True):
-    # Implements a very similar algorithm as for class-class relations, but just collecting classes based on instance count
-    # Outgoing properties - 400k instance limit, otherwise timeouts
-    # Incoming properties - 2mil instance limit, otherwise timeouts
+@profileStage
+def getClassPropertyRelations(sink, classDict, outgoingRelations=True):
+    # Implements a very similar algorithm as for class-class relations, but batching classes based on instance count
     # This goes on for quite a while, taking up to 4 hours to get the outgoing and incoming properties
     propertyLine = "?x ?property ?y \n"
-    classInstanceLimit = 400000
-    classInstanceLimit2 = 200000
-    classAmountLimit = 5000
     propertyDirectionString = "Outgoing" if outgoingRelations else "Incoming"
     if not outgoingRelations:
-        # For Incoming relations we can't batch together too many classes, as class instance amount doesn't perfectly correlate to query time 
-        classInstanceLimit = 2000000
         propertyLine = "?y ?property ?x. \n"
     query = """
         SELECT ?property ?class (COUNT(?y) AS ?propertyInstances) WHERE {{
@@ -470,61 +1225,34 @@ def getClassPropertyRelations(connection, classDict, outgoingRelations=True):
         }}
         GROUP BY ?property ?class
     """
-    i = 0
-    k = 0
-    instanceCounter = 0
-    totalClasses = len(classDict)
-    classList = ""
+    plannedBatches, skippedClasses = planClassBatches(classDict, 'outgoing' if outgoingRelations else 'incoming')
+    totalBatches = len(plannedBatches)
     relationList = []
-    collectedClasses = 0
-    cur = connection.cursor()
     totalInsertedRelations = 0
-    logging.info("Getting {} class-property relations for {} classes...".format(propertyDirectionString, totalClasses))
-    for key, value in classDict.items():
-        i = i + 1
-        if int(value['instances']) > classInstanceLimit:
-            # TO-DO should specifically process these larger classes, not just skip them
-            logging.warning("Class {} has too many instances, query will timeout, so skipping for now".format(key))
-            continue
-        # K: Counter to know which is the first processed class, can't use i for this, as we need also way to tell if it's the last class overall
-        k = k + 1
-        if k == 1 or i == totalClasses:
-            collectedClasses = collectedClasses + 1
-            classList = classList + " <" + key + ">"
-            instanceCounter = instanceCounter + int(value['instances'])
-            if k == 1:
-                continue
-        if not outgoingRelations:
-            # Calculate batch limits, so that for smaller classes as many classes are batched together, query doesn't time out. Problematic only for incoming relations
-            power = math.floor(math.log(i, 10))
-            classInstanceLimit2 = 1000000/pow(2, power)
-            classAmountLimit = pow(10, power) if power < 4 else 1000
-        if ((instanceCounter + int(value['instances'])) > classInstanceLimit2) or (collectedClasses  == classAmountLimit) or (i == totalClasses):
-            responseDict = queryWikiData(query.format(classList))
-            if responseDict is not None:
-                for j in responseDict:
-                    objectCnt = 0
-                    if not outgoingRelations:
-                        objectCnt = int(j['propertyInstances']['value'])
-                    relationList.append((j['class']['value'], j['property']['value'], int(j['propertyInstances']['value']), objectCnt))
-                responseDict.clear() # Clear the response dict as fast as we can, to free up used memory
-            classList = ""
-            instanceCounter = 0
-            collectedClasses = 0
-            currentRelations = len(relationList)
-            logging.info("{} property relations for {}/{} classes done...".format(propertyDirectionString, i, totalClasses))
-            if (currentRelations > 50000) or (i == totalClasses):
-                insertClassPropertyRelations(cur, relationList, outgoingRelations)
-                totalInsertedRelations = totalInsertedRelations + currentRelations
-                logging.info("{} {} relations collected".format(propertyDirectionString, totalInsertedRelations))
-                relationList.clear()
-        collectedClasses = collectedClasses + 1
-        classList = classList + " <" + key + ">"
-        instanceCounter = instanceCounter + int(value['instances'])
-    connection.commit()
-    cur.close()
+    logging.info("Getting {} class-property relations for {} classes in {} batches...".format(propertyDirectionString, len(classDict), totalBatches))
+    for key in skippedClasses:
+        # TO-DO should specifically process these larger classes, not just skip them
+        logging.warning("Class {} has too many instances, query will timeout, so skipping for now".format(key))
+    for i, (batchCost, batch) in enumerate(plannedBatches, 1):
+        classList = " ".join("<" + key + ">" for key in batch)
+        responseRows = queryWikiData(query.format(classList), heavy=True)
+        if responseRows is not None:
+            for prop, cl, propertyInstances in responseRows:
+                objectCnt = 0
+                if not outgoingRelations:
+                    objectCnt = int(propertyInstances)
+                relationList.append((cl, prop, int(propertyInstances), objectCnt))
+        currentRelations = len(relationList)
+        logging.info("{} property relations for {}/{} class batches done...".format(propertyDirectionString, i, totalBatches))
+        if (currentRelations > 50000) or (i == totalBatches):
+            sink.insertClassPropertyRelations(relationList, outgoingRelations)
+            totalInsertedRelations = totalInsertedRelations + currentRelations
+            logging.info("{} {} relations collected".format(propertyDirectionString, totalInsertedRelations))
+            relationList.clear()
+    sink.commit()
 
-def updateClassPropertyObjCount(connection, classDict):
+@profileStage
+def updateClassPropertyObjCount(sink, classDict):
     query = """
         SELECT ?property ?class (COUNT(?y) AS ?objectCnt) WHERE {{
            ?x wdt:P31 ?class.
@@ -534,52 +1262,30 @@ def updateClassPropertyObjCount(connection, classDict):
         }}
         GROUP BY ?property ?class
     """
-    i = 0
-    k = 0
-    instanceCounter = 0
-    totalClasses = len(classDict)
-    classList = ""
+    plannedBatches, skippedClasses = planClassBatches(classDict, 'objectCount')
+    totalBatches = len(plannedBatches)
     relationList = []
-    collectedClasses = 0
-    cur = connection.cursor()
     totalUpdatedRelations = 0
-    logging.info("Updating outgoing class-property relation object count for {} classes...".format(totalClasses))
-    for key, value in classDict.items():
-        i = i + 1
-        if int(value['instances']) > 400000:
-            # TO-DO should specifically process these larger classes, not just skip them
-            logging.warning("Class {} has too many instances, query will timeout, so skipping for now".format(key))
-            continue
-        # K: Counter to know which is the first processed class, can't use i for this, as we need also way to tell if it's the last class overall
-        k = k + 1
-        if k == 1 or i == totalClasses:
-            collectedClasses = collectedClasses + 1
-            classList = classList + " <" + key + ">"
-            instanceCounter = instanceCounter + int(value['instances'])
-            if k == 1:
-                continue
-        if ((instanceCounter + int(value['instances'])) > 400000) or (collectedClasses  == 5000) or (i == totalClasses):
-            responseDict = queryWikiData(query.format(classList))
-            if responseDict is not None:
-                for j in responseDict:
-                    relationList.append((j['class']['value'], j['property']['value'], int(j['objectCnt']['value'])))
-                responseDict.clear() # Clear the response dict as fast as we can, to free up used memory
-            classList = ""
-            instanceCounter = 0
-            collectedClasses = 0
-            currentRelations = len(relationList)
-            logging.info("Outgoing class-property relation object count for {}/{} updated...".format(i, totalClasses))
-            if (currentRelations > 50000) or (i == totalClasses):
-                updateClassPropertyRelations(cur, relationList)
-                totalUpdatedRelations = totalUpdatedRelations + currentRelations
-                logging.info("{} outgoing relations updated".format(totalUpdatedRelations))
-                relationList.clear()
-        collectedClasses = collectedClasses + 1
-        classList = classList + " <" + key + ">"
-        instanceCounter = instanceCounter + int(value['instances'])
-    connection.commit()
-    cur.close()
+    logging.info("Updating outgoing class-property relation object count for {} classes in {} batches...".format(len(classDict), totalBatches))
+    for key in skippedClasses:
+        # TO-DO should specifically process these larger classes, not just skip them
+        logging.warning("Class {} has too many instances, query will timeout, so skipping for now".format(key))
+    for i, (batchCost, batch) in enumerate(plannedBatches, 1):
+        classList = " ".join("<" + key + ">" for key in batch)
+        responseRows = queryWikiData(query.format(classList), heavy=True)
+        if responseRows is not None:
+            for prop, cl, objectCnt in responseRows:
+                relationList.append((cl, prop, int(objectCnt)))
+        currentRelations = len(relationList)
+        logging.info("Outgoing class-property relation object count for {}/{} class batches updated...".format(i, totalBatches))
+        if (currentRelations > 50000) or (i == totalBatches):
+            sink.updateClassPropertyRelations(relationList)
+            totalUpdatedRelations = totalUpdatedRelations + currentRelations
+            logging.info("{} outgoing relations updated".format(totalUpdatedRelations))
+            relationList.clear()
+    sink.commit()
 
+@profileStage
 def updatePropertyObjCount(propDict):
     # Update object count for properties
     # For properties with over 2mil uses in triples, we just take an estimate for 2mil
@@ -611,19 +1317,17 @@ def updatePropertyObjCount(propDict):
     for key, value in propDict.items():
         i = i + 1
         if int(value['useCount']) > 2000000:
-            responseDict = queryWikiData(limitQuery.format(property=" <" + key + ">"))
-            if responseDict is not None:
-                for j in responseDict:
-                    proportion =  int(j['objCount']['value']) / 2000000
+            responseRows = queryWikiData(limitQuery.format(property=" <" + key + ">"), heavy=True)
+            if responseRows is not None:
+                for row in responseRows:
+                    proportion =  int(row[0]) / 2000000
                     resultDict[key] = int(value['useCount']) * proportion
                     logging.info("<{}> property is too big, getting estimate obj count : {}".format(key, int(value['useCount']) * proportion))
-                responseDict.clear() # Clear the response dict as fast as we can, to free up used memory
             if (i == totalProperties): # Here let's catch the case, where last prop is large and we get obj count for props left in list
-                responseDict = queryWikiData(query.format(propertyList=propList))
-                if responseDict is not None:
-                    for j in responseDict:
-                        resultDict[j['property']['value']] = j['objectCnt']['value']
-                    responseDict.clear() # Clear the response dict as fast as we can, to free up used memory
+                responseRows = queryWikiData(query.format(propertyList=propList), heavy=True)
+                if responseRows is not None:
+                    for prop, objectCnt in responseRows:
+                        resultDict[prop] = objectCnt
         else:
             k = k + 1
             if k == 1 or i == totalProperties:
@@ -633,11 +1337,10 @@ def updatePropertyObjCount(propDict):
                 if k == 1:
                     continue
             if ((propCounter + int(value['useCount'])) > 6000000) or (collectedProps  == 5000) or (i == totalProperties):
-                responseDict = queryWikiData(query.format(propertyList=propList))
-                if responseDict is not None:
-                    for j in responseDict:
-                        resultDict[j['property']['value']] = j['objectCnt']['value']
-                    responseDict.clear() # Clear the response dict as fast as we can, to free up used memory
+                responseRows = queryWikiData(query.format(propertyList=propList), heavy=True)
+                if responseRows is not None:
+                    for prop, objectCnt in responseRows:
+                        resultDict[prop] = objectCnt
                 propList = ""
                 propCounter = 0
                 collectedProps = 0
@@ -646,8 +1349,83 @@ def updatePropertyObjCount(propDict):
             propCounter = propCounter + int(value['useCount'])
     return resultDict
 
-def getClasses():
+@profileStage
+def getPropertyPropertyRelations(sink, propDict):
+    # Count subjects, that have both of the properties, for every pair of properties
+    # For every property only first 1000 distinct subjects are taken in a subquery and joined with all of their triples,
+    # samples of several properties are joined with UNION into one query, same as in 'getPreviewClassPropertyRelations'
+    # Batches are limited by expected joined rows, sampled subjects times triples per subject, same order as class property batches
+    # To bound the output only top 50 other properties are kept for each property
+    logging.info("Getting property co-occurrence relations...")
+    topK = 50
+    subjectSample = 1000
+    # Wikidata items have a few hundred triples each, counting labels, descriptions and statement nodes
+    triplesPerSubject = 200
+    joinBudget = 2000000
+    subjectSampleQuery = """
+        {{SELECT DISTINCT (<{property}> AS ?property) ?x WHERE {{
+            ?x <{property}> [].}}
+        LIMIT {subjectSample}}}"""
+    # Pair of the property with itself is kept in the query, it gives the sampled subjects and their triples of the property
+    query = """
+        SELECT ?property ?otherProperty (COUNT(DISTINCT ?x) AS ?cnt) (COUNT(?y) AS ?triples) WHERE {{
+          {{ {samples} }}
+          ?x ?otherProperty ?y.
+        }}
+        GROUP BY ?property ?otherProperty
+    """
+    batches = []
+    propList = []
+    joinCounter = 0
+    for key, value in propDict.items():
+        # Use count is the number of triples, so it is also the upper bound of subjects
+        expectedRows = min(int(value['useCount']), subjectSample) * triplesPerSubject
+        if propList and ((joinCounter + expectedRows) > joinBudget or len(propList) == 100):
+            batches.append(propList)
+            propList = []
+            joinCounter = 0
+        propList.append(key)
+        joinCounter = joinCounter + expectedRows
+    if propList:
+        batches.append(propList)
+    totalQueries = len(batches)
+    relationList = []
+    totalInsertedRelations = 0
+    for i, batch in enumerate(batches, 1):
+        samples = " UNION ".join(subjectSampleQuery.format(property=key, subjectSample=subjectSample) for key in batch)
+        responseRows = queryWikiData(query.format(samples=samples), heavy=True)
+        if responseRows is None:
+            responseRows = ()
+        pairCounts = {}
+        sampledSubjects = {}
+        sampledTriples = {}
+        for prop, otherProp, cnt, triples in responseRows:
+            if otherProp == prop:
+                sampledSubjects[prop] = int(cnt)
+                sampledTriples[prop] = int(triples)
+            else:
+                pairCounts.setdefault(prop, []).append((int(cnt), otherProp))
+        for prop, counts in pairCounts.items():
+            if sampledSubjects.get(prop, 0) >= subjectSample:
+                # Property has more subjects than the sample, its subject count is estimated as use count over
+                # sampled triples per subject, so counts are scaled by subject count over sampled subjects
+                proportion = max(int(propDict[prop]['useCount']) / sampledTriples[prop], 1)
+                counts = [(int(cnt * proportion), otherProp) for cnt, otherProp in counts]
+            for cnt, otherProp in heapq.nlargest(topK, counts):
+                relationList.append((prop, otherProp, cnt))
+        currentRelations = len(relationList)
+        logging.info("Property co-occurrence for {}/{} batches done...".format(i, totalQueries))
+        if (currentRelations > 50000) or (i == totalQueries):
+            sink.insertPropertyPropertyRelations(relationList)
+            totalInsertedRelations = totalInsertedRelations + currentRelations
+            logging.info("{} property co-occurrence relations collected".format(totalInsertedRelations))
+            relationList.clear()
+    sink.commit()
+
+@profileStage
+def getClasses(limit=None):
     # Get all of the relevant classes from WikiData with at least 1 instance
+    # limit - get only the given number of largest classes
     # First get the classes with their instance count
     logging.info("Getting list of classes...")
     query = """
@@ -656,12 +1434,13 @@ def getClasses():
         }}
         GROUP BY ?class
         ORDER BY DESC(?instances)
+        {limit}
     """
-    responseDict = queryWikiData(query)
+    responseRows = queryWikiData(query.format(limit="LIMIT {}".format(limit) if limit else ""), heavy=True)
     classDict = {}
-    if responseDict is not None:
-        for i in responseDict:
-            classDict[i['class']['value']] = {'instances':int(i['instances']['value']), 'label': "", 'subclasses': 0}
+    if responseRows is not None:
+        for cl, instances in responseRows:
+            classDict[cl] = {'instances':int(instances), 'label': "", 'subclasses': 0}
     logging.info("{} classes retrieved".format(len(classDict)))
     # Then count the number of subclasses for each class, later used for getting class relations
     logging.info("Counting class subclasses...")
@@ -672,13 +1451,14 @@ def getClasses():
         GROUP BY ?class
         ORDER BY DESC(?subclasses)
     """
-    responseDict = queryWikiData(query)
-    if responseDict is not None:
-        for i in responseDict:
-            if i['class']['value'] in classDict:
-                classDict[i['class']['value']]['subclasses'] = int(i['subclasses']['value'])
+    responseRows = queryWikiData(query, heavy=True)
+    if responseRows is not None:
+        for cl, subclasses in responseRows:
+            if cl in classDict:
+                classDict[cl]['subclasses'] = int(subclasses)
     return classDict
 
+@profileStage
 def getClassLabels(classDict):
     # Get labels for classes in a given dictionary
     totalClasses = len(classDict)
@@ -696,15 +1476,16 @@ def getClassLabels(classDict):
         classList = classList + " <" + key + ">"
         # Query wikidata in batches of 15000 to maximize query time and minimize amount of queries
         if ((i % 15000) == 0) or (i == totalClasses):
-            responseDict = queryWikiData(query.format(classList))
-            if responseDict is not None:
-                for j in responseDict:
-                    if j['class']['value'] in classDict:
-                        classDict[j['class']['value']]['label'] = j['classLabel']['value']
+            responseRows = queryWikiData(query.format(classList), labelService=True)
+            if responseRows is not None:
+                for cl, classLabel in responseRows:
+                    if cl in classDict:
+                        classDict[cl]['label'] = classLabel
             classList = ""
             logging.info("{:.1%} done...".format(i/float(totalClasses)))
 
-def processLargeClasses(connection, classDict):
+@profileStage
+def processLargeClasses(sink, classDict):
     logging.info("Processing large class property relations...")
     # Process the largest class property relations which had too many instances
     # Get the property relations only for first 500k class instances and calculate aproximate property use count
@@ -738,7 +1519,6 @@ def processLargeClasses(connection, classDict):
     outgoingRelationList = []
     incomingRelationList = []
     outgoingObjCountList = []
-    cur = connection.cursor()
     # Iterate through all the classes ignoring classes with < 400k instances
     # Getting incoming property relations only for classes with > 2mil instances
     for key, value in classDict.items():
@@ -746,30 +1526,159 @@ def processLargeClasses(connection, classDict):
             continue
         if int(value['instances']) > 2000000:
             logging.info("Retrieving incoming class property relations for class ({})".format(key))
-            responseDict = queryWikiData(incomingPropsQuery.format(classIri=key))
-            if responseDict is not None:
-                for j in responseDict:
-                    useCount = int((float(j['useCount']['value']) / 500000) * int(value['instances']))
-                    incomingRelationList.append((key, j['property']['value'], useCount , useCount))
+            responseRows = queryWikiData(incomingPropsQuery.format(classIri=key), heavy=True)
+            if responseRows is not None:
+                for prop, sampleCount in responseRows:
+                    useCount = int((float(sampleCount) / 500000) * int(value['instances']))
+                    incomingRelationList.append((key, prop, useCount , useCount))
         logging.info("Retrieving outgoing class property relations for class ({})".format(key))
-        responseDict = queryWikiData(outgoingPropsQuery.format(classIri=key))
-        if responseDict is not None:
-            for j in responseDict:
-                useCount = int((float(j['useCount']['value']) / 500000) * int(value['instances']))
-                outgoingRelationList.append((key, j['property']['value'], useCount, 0))
+        responseRows = queryWikiData(outgoingPropsQuery.format(classIri=key), heavy=True)
+        if responseRows is not None:
+            for prop, sampleCount in responseRows:
+                useCount = int((float(sampleCount) / 500000) * int(value['instances']))
+                outgoingRelationList.append((key, prop, useCount, 0))
         logging.info("Getting outgoing class property relation object count for class ({})".format(key))
-        responseDict = queryWikiData(outgoingPropsObjCount.format(classIri=key))
-        if responseDict is not None:
-            for j in responseDict:
-                objCount = int((float(j['objectCnt']['value']) / 500000) * int(value['instances']))
-                outgoingObjCountList.append((key, j['property']['value'], objCount))
-    insertClassPropertyRelations(cur, incomingRelationList, False)
-    insertClassPropertyRelations(cur, outgoingRelationList, True)
-    updateClassPropertyRelations(cur, outgoingObjCountList)
-    connection.commit()
-    cur.close()
+        responseRows = queryWikiData(outgoingPropsObjCount.format(classIri=key), heavy=True)
+        if responseRows is not None:
+            for prop, sampleCount in responseRows:
+                objCount = int((float(sampleCount) / 500000) * int(value['instances']))
+                outgoingObjCountList.append((key, prop, objCount))
+    sink.insertClassPropertyRelations(incomingRelationList, False)
+    sink.insertClassPropertyRelations(outgoingRelationList, True)
+    sink.updateClassPropertyRelations(outgoingObjCountList)
+    sink.commit()
 
-def getClassPropertyConstraints(connection, classDict):
+@profileStage
+def getPreviewClassPropertyRelations(sink, classDict, sampleSize=1000, batchSize=20):
+    # Fast approximate class property relations for preview, only first sampleSize instances of every class are taken
+    # and their triples are counted. Every class in the batch gets its own instance sample subquery, joined with UNION,
+    # so one query covers a whole batch of classes. Sample has min(instances, sampleSize) instances,
+    # so counts are scaled by instances/sampleSize and are exact for classes with less instances than sampleSize
+    logging.info("Getting preview class property relations for {} classes...".format(len(classDict)))
+    outgoingSample = """
+        {{SELECT (<{classIri}> AS ?class) ?instance WHERE {{
+            ?instance wdt:P31 <{classIri}>.}}
+        LIMIT {sampleSize}}}
+        ?instance ?property ?y."""
+    incomingSample = """
+        {{SELECT (<{classIri}> AS ?class) ?instance WHERE {{
+            ?instance wdt:P31 <{classIri}>.}}
+        LIMIT {sampleSize}}}
+        ?y ?property ?instance."""
+    query = """
+        SELECT ?class ?property (COUNT(?y) AS ?useCount) (SUM(IF(isIRI(?y), 1, 0)) AS ?objectCnt) WHERE {{
+            {samples}
+        }}
+        GROUP BY ?class ?property
+    """
+    classList = list(classDict)
+    for outgoingRelations in (False, True):
+        sampleTemplate = outgoingSample if outgoingRelations else incomingSample
+        relationList = []
+        for start in range(0, len(classList), batchSize):
+            batch = classList[start:start + batchSize]
+            samples = " UNION ".join("{{{}}}".format(sampleTemplate.format(classIri=key, sampleSize=sampleSize)) for key in batch)
+            responseRows = queryWikiData(query.format(samples=samples), heavy=True)
+            if responseRows is None:
+                continue
+            sampledRelations = {}
+            for cl, prop, useCount, objectCnt in responseRows:
+                sampledRelations.setdefault(cl, []).append((prop, int(useCount), int(objectCnt)))
+            for cl, relations in sampledRelations.items():
+                proportion = max(int(classDict[cl]['instances']) / sampleSize, 1)
+                for prop, useCount, objectCnt in relations:
+                    # Same as for full export, incoming relation object count is the use count
+                    useCount = int(useCount * proportion)
+                    objectCnt = int(objectCnt * proportion) if outgoingRelations else useCount
+                    relationList.append((cl, prop, useCount, objectCnt))
+            logging.info("Preview {} relations for {}/{} classes done...".format(
+                "outgoing" if outgoingRelations else "incoming", min(start + batchSize, len(classList)), len(classList)))
+        sink.insertClassPropertyRelations(relationList, outgoingRelations)
+    sink.commit()
+
+@profileStage
+def getClassPropertyClassRelations(sink, classDict):
+    # Get distribution of object classes for every outgoing class property relation with objects
+    # Relations of smaller classes are batched together by object count, for classes with over 400k instances
+    # only first 500k objects for each class are taken and counts are estimated same as in 'processLargeClasses'
+    # To bound the output only top 50 object classes are kept for each class property relation
+    logging.info("Getting class property class relations...")
+    topK = 50
+    sampleSize = 500000
+    query = """
+        SELECT ?class ?property ?otherClass (COUNT(?y) AS ?cnt) WHERE {{
+          VALUES (?class ?property) {{ {pairList} }}
+          ?x wdt:P31 ?class.
+          ?x ?property ?y.
+          ?y wdt:P31 ?otherClass.
+        }}
+        GROUP BY ?class ?property ?otherClass
+    """
+    sampleQuery = """
+        SELECT ?property ?otherClass (COUNT(?y) AS ?cnt) WHERE {{
+          {{SELECT ?property ?y WHERE {{
+            ?x wdt:P31 <{classIri}>.
+            ?x ?property ?y.
+            FILTER isIRI(?y)
+          }} LIMIT {sampleSize}}}
+          ?y wdt:P31 ?otherClass.
+        }}
+        GROUP BY ?property ?otherClass
+    """
+    # Relations with no objects are already skipped by the sink
+    cpRelIds = {}
+    largeClasses = {}
+    batches = []
+    pairList = []
+    objectCounter = 0
+    for cpRelId, cl, prop, objectCnt in sink.getClassPropertyPairs():
+        cpRelIds[(cl, prop)] = cpRelId
+        if cl in classDict and int(classDict[cl]['instances']) > 400000:
+            largeClasses[cl] = largeClasses.get(cl, 0) + int(objectCnt)
+            continue
+        if pairList and ((objectCounter + int(objectCnt)) > 400000 or len(pairList) == 1000):
+            batches.append(pairList)
+            pairList = []
+            objectCounter = 0
+        pairList.append((cl, prop))
+        objectCounter = objectCounter + int(objectCnt)
+    if pairList:
+        batches.append(pairList)
+    # Each query is paired with the sampled class, or None for batched queries
+    queries = [(query.format(pairList=" ".join("(<{}> <{}>)".format(cl, prop) for cl, prop in batch)), None) for batch in batches]
+    queries = queries + [(sampleQuery.format(classIri=cl, sampleSize=sampleSize), cl) for cl in largeClasses]
+    totalQueries = len(queries)
+    logging.info("{} class property relations with objects, {} queries...".format(len(cpRelIds), totalQueries))
+    relationList = []
+    totalInsertedRelations = 0
+    for i, (cpcQuery, sampledClass) in enumerate(queries, 1):
+        targetCounts = {}
+        responseRows = queryWikiData(cpcQuery, heavy=True)
+        if responseRows is not None and sampledClass is None:
+            for cl, prop, otherClass, cnt in responseRows:
+                targetCounts.setdefault((cl, prop), []).append((int(cnt), otherClass))
+        elif responseRows is not None:
+            # If class has less objects than the sample size, the counts are exact
+            proportion = max(largeClasses[sampledClass] / sampleSize, 1)
+            logging.info("Class ({}) is too big, getting estimate class property class count".format(sampledClass))
+            for prop, otherClass, cnt in responseRows:
+                targetCounts.setdefault((sampledClass, prop), []).append((int(int(cnt) * proportion), otherClass))
+        for pair, counts in targetCounts.items():
+            if pair not in cpRelIds:
+                continue
+            for cnt, otherClass in heapq.nlargest(topK, counts):
+                relationList.append((cpRelIds[pair], otherClass, cnt))
+        currentRelations = len(relationList)
+        logging.info("Class property class relations for {}/{} queries done...".format(i, totalQueries))
+        if (currentRelations > 50000) or (i == totalQueries):
+            sink.insertClassPropertyClassRelations(relationList)
+            totalInsertedRelations = totalInsertedRelations + currentRelations
+            logging.info("{} class property class relations collected".format(totalInsertedRelations))
+            relationList.clear()
+    sink.commit()
+
+@profileStage
+def getClassPropertyConstraints(sink, classDict):
     logging.info("Getting Class-Property constraints...")
     query = """
         SELECT DISTINCT ?class ?property ?constraint {{
@@ -780,7 +1689,6 @@ def getClassPropertyConstraints(connection, classDict):
         }}
     """
     i = 0
-    cur = connection.cursor()
     classList = ""
     totalClasses = len(classDict)
     constraintList = []
@@ -790,19 +1698,26 @@ def getClassPropertyConstraints(connection, classDict):
         classList = classList + " <" + key + ">"
         if ((i % classLimit) == 0) or (i == totalClasses):
             classLimit = 10000 # For the rest of the classes group them up by 10k
-            responseDict = queryWikiData(query.format(classList=classList))
-            if responseDict is not None:
-                for j in responseDict:
-                    constraintType = 11 if j['constraint']['value'] == 'http://www.wikidata.org/entity/Q21503250' else 12
-                    constraintList.append((key, j['property']['value'], constraintType))
+            responseRows = queryWikiData(query.format(classList=classList))
+            if responseRows is not None:
+                for cl, prop, constraint in responseRows:
+                    constraintType = 11 if constraint == 'http://www.wikidata.org/entity/Q21503250' else 12
+                    constraintList.append((cl, prop, constraintType))
             classList = ""
             logging.info("{:.1%} done...".format(i/float(totalClasses)))
-    insertConstraintRelations(cur, constraintList)
-    connection.commit()
-    cur.close()
+    sink.insertConstraintRelations(constraintList)
+    sink.commit()
 
 if __name__ == '__main__':
-    databaseCon = getDbCon()
+    argParser = argparse.ArgumentParser(description='Extract schema from Wikidata into PostgreSQL database')
+    argParser.add_argument('--plan-only', action='store_true',
+        help='Only get the class list and print the planned query batches with their predicted cost, without running batch queries or writing to database')
+    argParser.add_argument('--import-snapshot', metavar='DIRECTORY',
+        help='Bulk load a Parquet snapshot written by the parquet output sink into the target database, instead of querying Wikidata')
+    argParser.add_argument('--preview', metavar='N', type=int,
+        help='Quickly export only the top N classes and properties with sampled relation counts. '
+             'A later full export into the same schema replaces the preview data')
+    args = argParser.parse_args()
 
     setSchemaName()
     setLogLevel()
@@ -814,25 +1729,59 @@ if __name__ == '__main__':
         force=True,
         datefmt='%Y-%m-%d %H:%M:%S'
     )
+    setSparqlEndpoints()
+    setProfiling()
+    setBatchPlans()
+
+    if args.plan_only:
+        printBatchPlan(getClasses())
+        raise SystemExit(0)
+
+    if args.import_snapshot:
+        databaseCon = getDbCon()
+        importSnapshot(databaseCon, args.import_snapshot)
+        databaseCon.close()
+        raise SystemExit(0)
+
+    sink = getSink()
+    sink.insertWikidataPrefixes()
 
-    insertWikidataPrefixes(databaseCon)
+    if args.preview:
+        if not isinstance(sink, PostgreSqlSink):
+            raise Exception("Preview is written straight into the database, it can't be used with other output sinks")
+        PREVIEW_MODE = True
+        propDict = getProperties(limit=args.preview)
+        getPropertyLabels(propDict)
+        sink.insertProperties(propDict)
+        propDict.clear()
+        classDict = getClasses(limit=args.preview)
+        getClassLabels(classDict)
+        sink.insertClasses(classDict)
+        getPreviewClassPropertyRelations(sink, classDict)
+        getClassClassRelations(sink, classDict)
+        getClassPropertyConstraints(sink, classDict)
+        classDict.clear()
+        sink.close()
+        raise SystemExit(0)
 
     propDict = getProperties()
     getPropertyLabels(propDict)
-    insertProperties(databaseCon, propDict)
+    sink.insertProperties(propDict)
     propObjCountDict = updatePropertyObjCount(propDict)
-    insertPropObjCount(databaseCon, propObjCountDict)
+    sink.insertPropObjCount(propObjCountDict)
+    getPropertyPropertyRelations(sink, propDict)
     propDict.clear() # Clear the massive dictionary, to not take up RAM space
 
     classDict = getClasses()
     getClassLabels(classDict)
-    insertClasses(databaseCon, classDict)
-    getClassPropertyRelations(databaseCon, classDict, outgoingRelations=False)
-    getClassPropertyRelations(databaseCon, classDict, outgoingRelations=True)
-    updateClassPropertyObjCount(databaseCon, classDict)
-    getClassClassRelations(databaseCon, classDict)
-    processLargeClasses(databaseCon, classDict)
-    getClassPropertyConstraints(databaseCon, classDict)
+    sink.insertClasses(classDict)
+    getClassPropertyRelations(sink, classDict, outgoingRelations=False)
+    getClassPropertyRelations(sink, classDict, outgoingRelations=True)
+    updateClassPropertyObjCount(sink, classDict)
+    getClassClassRelations(sink, classDict)
+    processLargeClasses(sink, classDict)
+    getClassPropertyConstraints(sink, classDict)
+    getClassPropertyClassRelations(sink, classDict)
     classDict.clear()
 
-    databaseCon.close()
+    sink.close()